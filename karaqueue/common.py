@@ -1,19 +1,23 @@
 """Common classes."""
 import asyncio
+import collections
 import configparser
 import contextlib
 import dataclasses
 import datetime
+import errno
+import functools
+import html
+import json
 import logging
 import os
 import pathlib
-import random
+import secrets
 import shutil
-import string
 import tempfile
-from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from typing import (
+    Any, Awaitable, Callable, Counter, Deque, Dict, List, Optional, Set, Tuple)
 import discord
-from NamedAtomicLock import NamedAtomicLock
 
 from karaqueue import utils
 
@@ -30,6 +34,12 @@ SERVING_DIR = CONFIG[_DEFAULT]['serving_dir']
 ALLOWED_GUILDIDS = list(
     map(int, CONFIG[_DEFAULT]['allowed_guildids'].strip().split(',')))
 DEV_CONTACT = CONFIG[_DEFAULT]['dev_contact']
+# Kept outside SERVING_DIR so cached downloads aren't served publicly. Should be on the same
+# filesystem as SERVING_DIR so they can be hard linked instead of copied.
+CACHE_DIR = CONFIG[_DEFAULT].get(
+    'cache_dir', fallback=f'{os.path.abspath(SERVING_DIR)}-cache')
+CACHE_SIZE_MB = CONFIG[_DEFAULT].getint('cache_size_mb', fallback=2048)
+PROCESS_WORKERS = CONFIG[_DEFAULT].getint('process_workers', fallback=2)
 
 VIDEO_LIMIT_MINS = 11
 MAX_QUEUED = 20
@@ -38,6 +48,21 @@ MAX_QUEUED_PER_USER = 2
 # Number of seconds after a new video started playing before the next button can be used.
 ADVANCE_BUFFER_SECS = 0
 
+# Number of seconds to wait for further changes before reprocessing a changed video.
+REPROCESS_DEBOUNCE_SECS = 0.5
+
+# Minimum number of seconds between download progress message updates.
+PROGRESS_INTERVAL_SECS = 0.5
+
+# Number of seconds between loading spinner updates while there is no progress message.
+SPINNER_INTERVAL_SECS = 1.0
+
+# Number of seconds to wait for further changes before reprinting the queue.
+PRINT_QUEUE_DEBOUNCE_SECS = 0.25
+
+# Buffer size in bytes for writing downloaded files.
+DOWNLOAD_BUFFER_SIZE = 64 * 1024
+
 
 def update_config_file() -> None:
     """Update config.ini."""
@@ -45,6 +70,61 @@ def update_config_file() -> None:
         CONFIG.write(file)
 
 
+# os.link errors meaning the file can't be hard linked there, so it is copied instead.
+_LINK_UNSUPPORTED_ERRNOS = frozenset([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP])
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hard link src to dst, or copy it if it can't be linked."""
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno not in _LINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copyfile(src, dst)
+
+
+def cache_get(key: str, path: str) -> bool:
+    """Link a cached download to path. Returns whether the key was in the cache."""
+    cache_path = os.path.join(CACHE_DIR, key)
+    try:
+        # An earlier run of the same entry may have linked it in already.
+        if not (os.path.exists(path) and os.path.samefile(cache_path, path)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            _link_or_copy(cache_path, path)
+        # Mark as recently used.
+        os.utime(cache_path)
+    except FileNotFoundError:
+        # Not cached, or evicted by a concurrent cache_put.
+        return False
+    return True
+
+
+def cache_put(key: str, path: str) -> None:
+    """Add a downloaded file to the cache, evicting the least recently used files if needed."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(CACHE_DIR, key)
+    try:
+        _link_or_copy(path, cache_path)
+    except FileExistsError:
+        return
+
+    files = []
+    with os.scandir(CACHE_DIR) as it:
+        for item in it:
+            if item.is_file():
+                stat = item.stat()
+                files.append((stat.st_mtime, stat.st_size, item.path))
+    files.sort()
+    total_size = sum(size for _, size, _ in files)
+    for _, size, file_path in files:
+        if total_size <= CACHE_SIZE_MB * 1024 * 1024:
+            break
+        os.remove(file_path)
+        total_size -= size
+
+
 @dataclasses.dataclass
 class LoadResult:
     """Results from loading a video."""
@@ -57,9 +137,73 @@ class LoadResult:
 LoadFn = Callable[['Entry', List[asyncio.Event]], Awaitable[LoadResult]]
 
 
+def _probe_streams(path: str) -> List[Dict[str, Any]]:
+    """Get the stream info of a media file."""
+    output = utils.call(
+        'ffprobe',
+        ['-v', 'error', '-of', 'json',
+         '-show_entries', 'stream=codec_type,width,height,r_frame_rate,sample_rate', path],
+        return_stdout=True)
+    return json.loads(output)['streams']
+
+
+# Page served at the entry url, so Discord embeds it as a video.
+INDEX_TEMPLATE = """<!DOCTYPE html>
+<html>
+    <head>
+        <meta property="og:title" content="{title}" />
+        <meta property="og:type" content="video" />
+        <meta property="og:image" content="{thumb_url}" />
+        <meta property="og:video" content="{video_url}" />
+        <meta property="og:video:width" content="{width}" />
+        <meta property="og:video:height" content="{height}" />
+        <meta property="og:video:type" content="video/mp4" />
+    </head>
+</html>
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _has_rubberband() -> bool:
+    """Whether the local ffmpeg was built with the rubberband filter."""
+    filters = utils.call('ffmpeg', ['-hide_banner', '-filters'], return_stdout=True)
+    return ' rubberband ' in filters
+
+
+def _pitch_shift_filter(pitch_shift: int, samplerate: int) -> str:
+    """Get the ffmpeg audio filter to shift the pitch by a number of semitones."""
+    ratio = 2 ** (pitch_shift / 12)
+    if _has_rubberband():
+        return f'rubberband=pitch={ratio}'
+    # Resample to change the pitch, then stretch back to the original tempo. atempo only
+    # accepts factors between 0.5 and 2, so chain it for bigger shifts.
+    filters = [f'asetrate={samplerate * ratio}', f'aresample={samplerate}']
+    tempo = 1 / ratio
+    while tempo < 0.5 or tempo > 2:
+        step = 0.5 if tempo < 0.5 else 2
+        filters.append(f'atempo={step}')
+        tempo /= step
+    filters.append(f'atempo={tempo}')
+    return ','.join(filters)
+
+
+# The event loop only keeps weak references to tasks, so keep fire and forget tasks alive here
+# until they finish.
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _background_task_done(task: asyncio.Task) -> None:
+    """Forget a finished background task and log its exception, if any."""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(task.exception(), exc_info=task.exception())
+
+
 @dataclasses.dataclass
-class Entry:
+class Entry:  # pylint: disable=too-many-instance-attributes
     """An entry in the queue."""
+    # Besides the song settings, an entry carries its own processing state (task, cancel event,
+    # change notification, schedule handle) so it can be reprocessed independently.
     path: str
     title: str
     original_url: str
@@ -71,13 +215,22 @@ class Entry:
     offset_ms: int
 
     processed: bool = False
+    _process_task: Optional[asyncio.Task] = None
     _process_task_cancel: Optional[asyncio.Event] = None
-    load_msg: str = ''
-    error_msg: str = ''
+    _load_msg: str = ''
+    _error_msg: str = ''
+    # Pulsed whenever processed, load_msg or error_msg changes. Waiters check the state before
+    # waiting, so it is never left set.
+    changed: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+    _loop: Optional[asyncio.AbstractEventLoop] = None
     _load_result: Optional[LoadResult] = None
     _processed_path: str = ''
+    _cache_buster: str = ''
 
     player_monitor_task: Optional[asyncio.Task] = None
+    process_schedule_handle: Optional[asyncio.TimerHandle] = None
+    # Sequence number of the latest processing request, older requests are ignored.
+    process_seq: int = -1
 
     @property
     def name(self) -> str:
@@ -87,6 +240,42 @@ class Entry:
             name = f'{name} [{self.pitch_shift:+d}]'
         return name
 
+    @property
+    def load_msg(self) -> str:
+        """The latest progress message while loading."""
+        return self._load_msg
+
+    @load_msg.setter
+    def load_msg(self, msg: str) -> None:
+        self._load_msg = msg
+        self._notify_changed()
+
+    @property
+    def error_msg(self) -> str:
+        """The error message if loading failed."""
+        return self._error_msg
+
+    @error_msg.setter
+    def error_msg(self, msg: str) -> None:
+        self._error_msg = msg
+        self._notify_changed()
+
+    def _notify_changed(self) -> None:
+        # The messages are also written from the processing threads, and asyncio.Event is not
+        # thread safe.
+        loop = self._loop or asyncio.get_running_loop()
+        loop.call_soon_threadsafe(self._pulse_changed)
+
+    def _pulse_changed(self) -> None:
+        # Setting wakes up every current waiter even though it is cleared right away.
+        self.changed.set()
+        self.changed.clear()
+
+    @property
+    def processing(self) -> bool:
+        """Whether the entry is currently being processed."""
+        return self._process_task_cancel is not None
+
     def onchange_locked(self) -> None:
         """A change that requires reprocessing the video was made."""
         self._reset()
@@ -99,14 +288,28 @@ class Entry:
         """Return a task that processes the video."""
         self._reset()
         cancel = asyncio.Event()
+        previous_task = self._process_task
 
         async def process():
-            logging.info(f'Start processing {self.original_url}')
-            await self._process([global_cancel, cancel])
+            try:
+                # A cancelled run may still be writing to the entry directory, let it stop first.
+                if previous_task is not None:
+                    await asyncio.wait([previous_task])
+                logging.info(f'Start processing {self.original_url}')
+                await self._process([global_cancel, cancel])
+            finally:
+                if self._process_task_cancel is cancel:
+                    self._process_task_cancel = None
+            if cancel.is_set():
+                # Superseded by a newer run, which owns processed now.
+                return
             self.processed = True
+            self._pulse_changed()
             logging.info(f'Finished processing {self.original_url}')
         self._process_task_cancel = cancel
-        return loop.create_task(process())
+        self._loop = loop
+        self._process_task = loop.create_task(process())
+        return self._process_task
 
     def _reset(self) -> None:
         if self._process_task_cancel is not None:
@@ -115,12 +318,25 @@ class Entry:
         if self.player_monitor_task is not None:
             self.player_monitor_task.cancel()
             self.player_monitor_task = None
+        if self.process_schedule_handle is not None:
+            self.process_schedule_handle.cancel()
+            self.process_schedule_handle = None
         self.processed = False
 
     def delete(self) -> None:
         """Delete everything associated with this entry."""
         self._reset()
         self.error_msg = 'Cancelled'
+        process_task = self._process_task
+
+        async def remove_files():
+            # Let a cancelled processing run stop writing to the directory first.
+            if process_task is not None:
+                await asyncio.wait([process_task])
+            await asyncio.to_thread(shutil.rmtree, self.path, ignore_errors=True)
+        task = asyncio.get_running_loop().create_task(remove_files())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_task_done)
 
     def _get_server_path(self, path: str) -> str:
         """Get external base path of this entry."""
@@ -132,8 +348,7 @@ class Entry:
         """Get external video url for this entry."""
         if not self.processed:
             raise RuntimeError('task has not been processed!')
-        return (self._get_server_path(self.path) +
-                '?' + ''.join(random.choice(string.ascii_letters) for _ in range(8)))
+        return f'{self._get_server_path(self.path)}?{self._cache_buster}'
 
     def video_path(self) -> str:
         """Get internal path to processed video."""
@@ -144,39 +359,44 @@ class Entry:
     async def _process(self, cancel: List[asyncio.Event]) -> None:
         """Process the video."""
         if self._load_result is None:
-            self._load_result = LoadResult()
-            for load_fn in self.load_fns:
-                try:
-                    res = await load_fn(self, cancel)
-                except asyncio.CancelledError:  # pylint: disable=try-except-raise
-                    raise
-                except Exception as err:  # pylint: disable=broad-except
-                    logging.exception(err)
-                    self.error_msg = f'Error: {err}'
+            load_result = LoadResult()
+            # The video and audio may come from different urls, download them concurrently.
+            results = await asyncio.gather(
+                *(load_fn(self, cancel) for load_fn in self.load_fns), return_exceptions=True)
+            # Errors from a cancelled run must not overwrite the state of the run replacing it.
+            for event in cancel:
+                if event.is_set():
+                    raise asyncio.CancelledError()
+            for res in results:
+                if isinstance(res, asyncio.CancelledError):
+                    raise res
+                if isinstance(res, Exception):
+                    logging.error(res, exc_info=res)
+                    self.error_msg = f'Error: {res}'
                     return
                 if res.video_path:
-                    self._load_result.video_path = res.video_path
+                    load_result.video_path = res.video_path
                 if res.audio_path:
-                    self._load_result.audio_path = res.audio_path
+                    load_result.audio_path = res.audio_path
                 if res.width:
-                    self._load_result.width = res.width
+                    load_result.width = res.width
                 if res.height:
-                    self._load_result.height = res.height
+                    load_result.height = res.height
+            # Only kept once every download finished, so a cancelled run is downloaded again.
+            self._load_result = load_result
 
         for event in cancel:
             if event.is_set():
                 raise asyncio.CancelledError()
 
-        if self._load_result.width == 0 or self._load_result.height == 0:
-            dimensions = utils.call(
-                'ffprobe',
-                '-loglevel quiet -select_streams v:0 -show_entries stream=width,height -of csv=p=0 '
-                f'"{os.path.join(self.path, self._load_result.video_path)}"',
-                return_stdout=True)
-            self._load_result.width, self._load_result.height = map(
-                int, dimensions.split(','))
-
-        await asyncio.to_thread(self._process_load_result, cancel)
+        try:
+            await asyncio.to_thread(self._process_load_result, cancel)
+        except Exception as err:  # pylint: disable=broad-except
+            for event in cancel:
+                if event.is_set():
+                    raise asyncio.CancelledError() from err
+            logging.error(err, exc_info=err)
+            self.error_msg = f'Error: {err}'
 
     def _process_load_result(self, cancel: List[asyncio.Event]) -> None:
         if self.queue is None:
@@ -185,106 +405,106 @@ class Entry:
             raise ValueError('load_result is None! This should not happen!')
         video_path = os.path.join(self.path, self._load_result.video_path)
         audio_path = os.path.join(self.path, self._load_result.audio_path)
-        if self.pitch_shift:
-            self.load_msg = f'Loading video `{self.title}`...\nShifting pitch...'
-            shift_path = os.path.join(self.path, 'shifted.mp3')
-            pitch_cents = int(self.pitch_shift * 100)
-            utils.call(
-                'sox', f'"{audio_path}" "{shift_path}" pitch {pitch_cents}')
-            audio_path = shift_path
-
-        for event in cancel:
-            if event.is_set():
-                raise asyncio.CancelledError()
-
-        framerate = utils.call(
-            'ffprobe',
-            '-v 0 -of csv=p=0 -select_streams v:0 -show_entries '
-            f'stream=r_frame_rate -i "{video_path}"',
-            return_stdout=True,
-        ).strip()
-        samplerate = utils.call(
-            'ffprobe',
-            '-v error -select_streams a -of default=noprint_wrappers=1:nokey=1 '
-            f' -show_entries stream=sample_rate -i "{audio_path}"',
-            return_stdout=True,
-        ).strip()
+        thumb_path = os.path.join(self.path, 'thumb.jpg')
+        # Probe the video once for everything we need; the audio usually comes from the same file.
+        streams = _probe_streams(video_path)
+        video_stream = next(
+            (stream for stream in streams if stream['codec_type'] == 'video'), None)
+        if video_stream is None:
+            raise ValueError('No video stream found in the video!')
+        if audio_path != video_path:
+            streams = _probe_streams(audio_path)
+        audio_stream = next(
+            (stream for stream in streams if stream['codec_type'] == 'audio'), None)
+        if audio_stream is None:
+            raise ValueError('No audio stream found in the audio!')
+        framerate = video_stream['r_frame_rate']
+        samplerate = audio_stream['sample_rate']
+        if self._load_result.width == 0 or self._load_result.height == 0:
+            self._load_result.width = int(video_stream['width'])
+            self._load_result.height = int(video_stream['height'])
         title_video_path = os.path.join(self.path, 'title.mp4')
         if not os.path.exists(title_video_path):
             title_path = os.path.join(self.path, 'title.jpg')
-            escaped_title = self.title.replace('"', '\\"')
             utils.call(
                 'convert',
-                f'-background black -size {self._load_result.width}x{self._load_result.height} '
-                '-fill "#ff0080" -pointsize 60 -font "Yu-Gothic-Medium-&-Yu-Gothic-UI-Regular" '
-                f'-gravity center caption:"{escaped_title}" "{title_path}"'
+                ['-background', 'black',
+                 '-size', f'{self._load_result.width}x{self._load_result.height}',
+                 '-fill', '#ff0080', '-pointsize', '60',
+                 '-font', 'Yu-Gothic-Medium-&-Yu-Gothic-UI-Regular',
+                 '-gravity', 'center', f'caption:{self.title}', title_path],
             )
             utils.call(
                 'ffmpeg',
-                f'-framerate {framerate} -loop 1 -t 3 -i {title_path} '
-                f'-f lavfi -i anullsrc=cl=stereo:r={samplerate} -t 3 '
-                f'-vf "fade=in:0:d=0.5, fade=out:st=2.5:d=0.5" '
-                f'"{title_video_path}"',
+                [*utils.FFMPEG_FLAGS,
+                 '-framerate', framerate, '-loop', '1', '-t', '3', '-i', title_path,
+                 '-f', 'lavfi', '-i', f'anullsrc=cl=stereo:r={samplerate}', '-t', '3',
+                 '-vf', 'fade=in:0:d=0.5, fade=out:st=2.5:d=0.5',
+                 # Re-encoded again when concatenated, so encode it quickly.
+                 '-c:v', 'libx264', '-preset', 'ultrafast', '-threads', '0',
+                 title_video_path],
             )
 
         for event in cancel:
             if event.is_set():
                 raise asyncio.CancelledError()
 
-        offset_ms = self.offset_ms + self.queue.global_offset_ms
-        if offset_ms == 0:
-            input_flags = (f'-i "{video_path}" -i "{audio_path}" -c:v copy -c:a copy '
-                           f'-map 0:v:0 -map 1:a:0')
-        elif offset_ms > 0:
-            input_flags = (f'-i "{video_path}" -i "{audio_path}" -c:v copy -c:a mp3 '
-                           f'-af "adelay={offset_ms}|{offset_ms}" -map 0:v:0 -map 1:a:0')
-        else:
-            delay_str = datetime.timedelta(milliseconds=-offset_ms)
-            input_flags = (f'-i "{audio_path}" -itsoffset {delay_str} -i "{video_path}" '
-                           f'-c:a copy -c:v copy -map 1:v:0 -map 0:a:0')
-
         self.load_msg = f'Loading video `{self.title}`...\nCreating video...'
-        main_video_path = tempfile.mktemp(dir=self.path, suffix='.mp4')
-        utils.call(
-            'ffmpeg', f'-hwaccel cuda {input_flags} -movflags faststart "{main_video_path}"')
-
-        for event in cancel:
-            if event.is_set():
-                raise asyncio.CancelledError()
+        # Offset, pitch shift and the title card are all applied in a single ffmpeg pass straight
+        # from the downloaded files, without writing an intermediate muxed video.
+        offset_ms = self.offset_ms + self.queue.global_offset_ms
+        input_flags = ['-i', title_video_path]
+        if offset_ms < 0:
+            input_flags += ['-itsoffset', str(datetime.timedelta(milliseconds=-offset_ms))]
+        input_flags += ['-i', video_path]
+        audio_label = '[1:a:0]'
+        if audio_path != video_path or offset_ms < 0:
+            input_flags += ['-i', audio_path]
+            audio_label = '[2:a:0]'
+        audio_filters = []
+        if offset_ms > 0:
+            audio_filters.append(f'adelay={offset_ms}|{offset_ms}')
+        if self.pitch_shift:
+            audio_filters.append(_pitch_shift_filter(self.pitch_shift, int(samplerate)))
+        filter_graph = '[0:v]format=yuv420p[v0];[1:v:0]setsar=1,format=yuv420p[v1];'
+        if audio_filters:
+            filter_graph += f'{audio_label}{",".join(audio_filters)}[a1];'
+            audio_label = '[a1]'
+        filter_graph += f'[v0][0:a][v1]{audio_label}concat=n=2:v=1:a=1[v][a]'
+        output_flags = ['-map', '[v]', '-map', '[a]', '-c:v', 'libx264', '-preset', 'veryfast',
+                        '-c:a', 'aac', '-aac_coder', 'fast', '-threads', '0',
+                        '-movflags', '+faststart']
 
         self._processed_path = tempfile.mktemp(dir=self.path, suffix='.mp4')
+        output_flags.append(self._processed_path)
+        # New query string for every processed video so Discord doesn't reuse a stale embed.
+        self._cache_buster = secrets.token_urlsafe(6)
+        thumb_tmp_path = ''
+        if not os.path.exists(thumb_path):
+            # Grab the thumbnail from the first frame the same pass decodes anyway. Written to a
+            # temporary path so a cancelled run can't leave a truncated thumbnail behind.
+            thumb_tmp_path = tempfile.mktemp(dir=self.path, suffix='.jpg')
+            output_flags += ['-map', '1:v:0', '-frames:v', '1', '-q:v', '3', thumb_tmp_path]
         utils.call(
             'ffmpeg',
-            f'-hwaccel cuda -i "{title_video_path}" -i "{main_video_path}" -filter_complex '
-            '"[0:v]format=yuv420p[v0];[1:v]setsar=1,format=yuv420p[v1];'
-            '[v0][0:a][v1][1:a]concat=n=2:v=1:a=1[v][a]" '
-            '-map "[v]" -map "[a]" -c:v libx264 -c:a aac -movflags +faststart '
-            f'"{self._processed_path}"')
+            [*utils.FFMPEG_FLAGS, '-hwaccel', 'cuda', *input_flags,
+             '-filter_complex', filter_graph, *output_flags],
+            cancel=cancel)
+        if thumb_tmp_path:
+            os.replace(thumb_tmp_path, thumb_path)
 
         for event in cancel:
             if event.is_set():
                 raise asyncio.CancelledError()
 
-        thumb_path = os.path.join(self.path, 'thumb.jpg')
-        if not os.path.exists(thumb_path):
-            utils.call('ffmpeg',
-                       rf'-i "{video_path}" -vf "select=eq(n\,0)" -q:v 3 "{thumb_path}"')
-
-        index_path = os.path.join(self.path, 'index.html')
-        with open(index_path, 'w', encoding='utf-8') as index_file:
-            index_file.write(f"""<!DOCTYPE html>
-<html>
-    <head>
-        <meta property="og:title" content="{self.name}" />
-        <meta property="og:type" content="video" />
-        <meta property="og:image" content="{self._get_server_path(thumb_path)}" />
-        <meta property="og:video" content="{self._get_server_path(self._processed_path)}" />
-        <meta property="og:video:width" content="{self._load_result.width}" />
-        <meta property="og:video:height" content="{self._load_result.height}" />
-        <meta property="og:video:type" content="video/mp4" />
-    </head>
-</html>
-""")
+        index_html = INDEX_TEMPLATE.format_map({
+            'title': html.escape(self.name),
+            'thumb_url': self._get_server_path(thumb_path),
+            'video_url': self._get_server_path(self._processed_path),
+            'width': self._load_result.width,
+            'height': self._load_result.height,
+        })
+        pathlib.Path(self.path, 'index.html').write_text(index_html, encoding='utf-8')
 
 
 @dataclasses.dataclass
@@ -294,8 +514,14 @@ class Queue:
     channel_id: int
     msg_id: Optional[int] = None
     current: Optional[Entry] = None
-    queue: List[Entry] = dataclasses.field(default_factory=list)
-    lock = asyncio.Lock()
+    queue: Deque[Entry] = dataclasses.field(default_factory=collections.deque)
+    # Number of queued entries per user id, kept in sync by the methods below.
+    user_counts: Counter[int] = dataclasses.field(default_factory=collections.Counter)
+    lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+    # Guards msg, separately from lock so printing the queue doesn't block other commands.
+    msg_lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+    # Incremented for every requested queue print, so only the latest one is sent.
+    print_seq: int = 0
 
     per_user_limit: int = MAX_QUEUED_PER_USER
     global_offset_ms: int = 0
@@ -309,9 +535,12 @@ class Queue:
         return self.queue[index]
 
     def __setitem__(self, index, item):
+        self.user_counts[self.queue[index].user_id] -= 1
         self.queue[index] = item
+        self.user_counts[item.user_id] += 1
 
     def __delitem__(self, index):
+        self.user_counts[self.queue[index].user_id] -= 1
         del self.queue[index]
 
     def __iter__(self):
@@ -321,45 +550,27 @@ class Queue:
     def insert(self, index, item):
         """Insert."""
         self.queue.insert(index, item)
+        self.user_counts[item.user_id] += 1
 
     def append(self, item):
         """Append."""
         self.queue.append(item)
+        self.user_counts[item.user_id] += 1
 
-    def pop(self, index):
-        """Pop."""
-        return self.queue.pop(index)
+    def popleft(self):
+        """Pop from the front."""
+        item = self.queue.popleft()
+        self.user_counts[item.user_id] -= 1
+        return item
 
     def format(self) -> str:
         """Format the queue as a string."""
-        resp = []
-        for i, entry in enumerate(self):
-            row = f'{i+1}. [`{entry.name}`](<{entry.original_url}>)'
-            resp.append(row)
-        return '\n'.join(resp)
+        return '\n'.join(
+            f'{i+1}. [`{entry.name}`](<{entry.original_url}>)' for i, entry in enumerate(self))
 
 
 queues: Dict[Tuple[int, int], Queue] = {}
 
-lock_dir = os.path.join(tempfile.gettempdir(), 'server_lock')
-if os.path.exists(lock_dir):
-    shutil.rmtree(lock_dir)
-os.makedirs(lock_dir)
-
-
-@contextlib.contextmanager
-def named_lock(name):
-    """Named atomic lock."""
-    lock = NamedAtomicLock(name, lockDir=lock_dir)
-    try:
-        lock.acquire(timeout=30)
-        if not lock.hasLock:
-            raise ValueError(f'Could not acquire lock {name}')
-        yield lock
-    finally:
-        lock.release()
-
-
 async def get_queue_key(ctx: utils.DiscordContext) -> Tuple[int, int]:
     """Get the queue key corresponding to the given guild and channel."""
     guild_id = ctx.guild_id
@@ -378,11 +589,12 @@ async def get_queue(ctx: utils.DiscordContext) -> Queue:
         msg = f'This server is not allowed to use this bot. Please contact {DEV_CONTACT}.'
         await utils.respond(ctx, content=f'Error: {msg}', ephemeral=True)
         raise ValueError(f'{msg}: {key[0]}')
-    with named_lock('get_queue'):
-        if key not in queues:
-            logging.info(f'Created new queue with key {key}')
-            queues[key] = Queue(guild_id=key[0], channel_id=key[1])
-    return queues[key]
+    # No await between the lookup and the insert, so this can't race with another command.
+    q = queues.get(key)
+    if q is None:
+        logging.info(f'Created new queue with key {key}')
+        q = queues[key] = Queue(guild_id=key[0], channel_id=key[1])
+    return q
 
 
 @dataclasses.dataclass
@@ -1,13 +1,12 @@
 """bilibili downloader."""
 import asyncio
 import logging
-import os
 import pathlib
+import time
 from typing import List
 import bilix.progress.cli_progress
 import bilix.utils
 import discord
-import StringProgressBar
 from bilix.sites.bilibili import api, DownloaderBilibili
 
 from karaqueue import common
@@ -27,6 +26,7 @@ class Progress(bilix.progress.cli_progress.CLIProgress):
     def __init__(self, entry: common.Entry, cancel: List[asyncio.Event]) -> None:
         self._entry = entry
         self._cancel = cancel
+        self._last_update = 0.0
         super().__init__()
 
     async def update(self, task_id, **kwargs):
@@ -35,12 +35,17 @@ class Progress(bilix.progress.cli_progress.CLIProgress):
                 raise asyncio.CancelledError()
         task = self.tasks[task_id]
         await super().update(task_id, **kwargs)
+        # Called for every downloaded chunk, only update the message every PROGRESS_INTERVAL_SECS.
+        now = time.monotonic()
+        if now - self._last_update < common.PROGRESS_INTERVAL_SECS and (
+                task.total is None or task.completed < task.total):
+            return
+        self._last_update = now
         if task.total is None:
             self._entry.load_msg = f'Loading bilibili video `{self._entry.title}`...'
         else:
             total_size_mb = task.total / 1024 / 1024
-            progress = StringProgressBar.progressBar.filledBar(
-                task.total, task.completed)  # type: ignore
+            progress = utils.progress_bar(task.total, task.completed)
             self._entry.load_msg = (
                 f'Loading bilibili video `{self._entry.title}`...\n'
                 f'Downloading: {progress[0]} {progress[1]:0.0f}% of {total_size_mb:0.1f}Mb')
@@ -82,9 +87,7 @@ class BilibiliDownloader(common.Downloader):
             if video:
                 result.video_path = video_path
             if audio:
-                result.audio_path = 'audio.mp3'
-                utils.call('ffmpeg', f'-i "{os.path.join(entry.path, video_path)}" '
-                           f'-ac 2 -f mp3 "{os.path.join(entry.path, result.audio_path)}"')
+                result.audio_path = video_path
             return result
 
         return common.DownloadResult(
@@ -4,9 +4,9 @@ import base64
 import functools
 import os
 import tempfile
+import time
 from typing import List
 import discord
-import StringProgressBar
 
 from karaqueue import common
 from karaqueue import utils
@@ -44,10 +44,11 @@ class NicoNicoDownloader(common.Downloader):
         self, interaction: discord.Interaction, url: str, *, video: bool, audio: bool,
     ) -> common.DownloadResult:
         url = url.replace('sp.nicovideo.jp', 'nicovideo.jp')
-        sess, session_cookie = nicoutils.login(
-            USERNAME, PASSWORD, SESSION_COOKIE)
+        # Both are blocking requests calls, keep them off the event loop.
+        sess, session_cookie = await asyncio.to_thread(
+            nicoutils.login, USERNAME, PASSWORD, SESSION_COOKIE)
         update_session_cookie(session_cookie)
-        params = nicoutils.get_video_params(sess, url)
+        params = await asyncio.to_thread(nicoutils.get_video_params, sess, url)
         title = params['video']['title']
         duration = params['video']['duration']
         if duration == 0:
@@ -62,12 +63,20 @@ class NicoNicoDownloader(common.Downloader):
                 USERNAME, PASSWORD, SESSION_COOKIE)
             update_session_cookie(session_cookie)
 
+            last_update = [0.0]
+            last_pct = [-1]
+
             def progress_func(current: int, total_size: int, parts: bool = False):
                 for event in cancel:
                     if event.is_set():
                         raise asyncio.CancelledError()
-                progress = StringProgressBar.progressBar.filledBar(
-                    total_size, current)  # type: ignore
+                now = time.monotonic()
+                pct = int(100 * current / total_size) if total_size else 0
+                if pct == last_pct[0] or now - last_update[0] < common.PROGRESS_INTERVAL_SECS:
+                    return
+                last_update[0] = now
+                last_pct[0] = pct
+                progress = utils.progress_bar(total_size, current)
                 if parts:
                     entry.load_msg = (
                         f'Loading niconico video `{title}`...\n'
@@ -86,14 +95,12 @@ class NicoNicoDownloader(common.Downloader):
 
             if audio:
                 if video:
-                    video_path = os.path.join(entry.path, result.video_path)
+                    result.audio_path = result.video_path
                 else:
                     video_path = tempfile.mktemp(dir=entry.path, suffix='.mp4')
                     nicoutils.download_video(
                         sess, url, video_path, progress_func)
-                result.audio_path = 'audio.mp3'
-                utils.call('ffmpeg', f'-i "{video_path}" '
-                           f'-ac 2 -f mp3 "{os.path.join(entry.path, result.audio_path)}"')
+                    result.audio_path = os.path.basename(video_path)
             return result
 
         return common.DownloadResult(
@@ -184,8 +184,6 @@ def _download_hls(m3u8_url, filename, session, on_progress, threads):
     iv = key_match["iv"]
     iv = bytes.fromhex(iv)
     init_url = init_match["url"]
-    with open(filename, "wb") as f:
-        f.write(session.get(init_url).content)
 
     def download_segment(segment):
         with session.get(segment) as r:
@@ -193,12 +191,14 @@ def _download_hls(m3u8_url, filename, session, on_progress, threads):
             cipher = AES.new(key, AES.MODE_CBC, iv=iv)
             return unpad(cipher.decrypt(r.content), AES.block_size)
 
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        results = executor.map(download_segment, segments)
-        for i, decrypted in enumerate(results):
-            with open(filename, "ab") as f:
+    # Keep the file open across segments instead of reopening it to append each one.
+    with open(filename, "wb", buffering=BLOCK_SIZE) as f:
+        f.write(session.get(init_url).content)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = executor.map(download_segment, segments)
+            for i, decrypted in enumerate(results):
                 f.write(decrypted)
-            on_progress(i, len(segments), parts=True)
+                on_progress(i, len(segments), parts=True)
 
 
 def download_video(
@@ -234,10 +234,11 @@ def download_video(
 
             # Video and audio
             if len(tasks) > 1:
-                input_flags = (f'-i "{tasks[0]["filename"]}" -i "{tasks[1]["filename"]}" '
-                               '-c:v copy -c:a copy -map 0:v:0 -map 1:a:0')
+                input_flags = ['-i', tasks[0]["filename"], '-i', tasks[1]["filename"],
+                               '-c:v', 'copy', '-c:a', 'copy', '-map', '0:v:0', '-map', '1:a:0']
                 utils.call(
-                    'ffmpeg', f'{input_flags} -movflags faststart {filename}')
+                    'ffmpeg',
+                    [*utils.FFMPEG_FLAGS, *input_flags, '-movflags', 'faststart', filename])
             # Only audio or video
             else:
                 shutil.move(tasks[0]["filename"], filename)
@@ -36,7 +36,8 @@ class SoundcloudDownloader(common.Downloader):
             result = common.LoadResult()
             if audio:
                 result.audio_path = 'audio.mp3'
-                with open(os.path.join(entry.path, result.audio_path), 'wb+') as file:
+                with open(os.path.join(entry.path, result.audio_path), 'wb+',
+                          buffering=common.DOWNLOAD_BUFFER_SIZE) as file:
                     await track.write_mp3_to(file)
             return result
 
@@ -1,13 +1,20 @@
 """Youtube utils."""
 import asyncio
+import collections
+import contextlib
+import copy
+import dataclasses
 import functools
 import logging
 import os
 import re
-from typing import Any, List
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import discord
 from yt_dlp import YoutubeDL
-import StringProgressBar
+from yt_dlp.utils import DownloadError
 
 from karaqueue import common
 from karaqueue import utils
@@ -15,7 +22,149 @@ from karaqueue import utils
 logger = logging.getLogger(__name__)
 
 
-YOUTUBE_PATTERN = re.compile(r'(vi/|v=|/v/|youtu.be/|/embed/)')
+YOUTUBE_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]{11}')
+# Path prefixes that are followed by the video id, e.g. youtube.com/embed/<id> or
+# i.ytimg.com/vi/<id>/hqdefault.jpg.
+_VIDEO_ID_PATH_PREFIXES = frozenset(['embed', 'v', 'vi', 'shorts', 'live'])
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """Extract the video id from a youtube url."""
+    if '//' not in url:
+        url = f'//{url}'
+    parsed = urllib.parse.urlparse(url)
+    parts = parsed.path.split('/')
+    if parsed.hostname is not None and parsed.hostname.endswith('youtu.be'):
+        vid = parts[1] if len(parts) > 1 else None
+    else:
+        vid = urllib.parse.parse_qs(parsed.query).get('v', [None])[0]
+        if vid is None and len(parts) > 2 and parts[1] in _VIDEO_ID_PATH_PREFIXES:
+            vid = parts[2]
+    if vid is None or not YOUTUBE_ID_PATTERN.fullmatch(vid):
+        return None
+    return vid
+
+
+@dataclasses.dataclass(frozen=True)
+class VideoInfo:
+    """Metadata for a youtube video."""
+    title: str
+    duration: int
+    webpage_url: str
+    # The full extracted info, including the available formats.
+    info: Dict[str, Any] = dataclasses.field(compare=False, repr=False)
+
+
+# Download in 10MiB ranged requests. Youtube throttles requests for a whole stream, and larger
+# ranges mean fewer round trips per video than yt-dlp's default.
+_HTTP_CHUNK_SIZE = 10 * 1024 * 1024
+# Fragmented (DASH/HLS) formats are fetched over several connections at once.
+_CONCURRENT_FRAGMENTS = 4
+
+
+# Shared YoutubeDL instance for metadata lookups, so the youtube player JS it downloads and
+# parses is reused across videos instead of being fetched again for every lookup.
+_ydl: Optional[YoutubeDL] = None  # pylint: disable=invalid-name
+_ydl_lock = threading.Lock()
+# How long to wait for another lookup using the shared instance before using a separate one.
+_YDL_LOCK_TIMEOUT_SECS = 5
+# Errors that mean the cached player JS is stale, rather than a problem with the video itself.
+_STALE_PLAYER_ERROR_PATTERN = re.compile(r'signature|nsig|player', re.IGNORECASE)
+
+
+def _extract_info(url: str) -> Any:
+    """Extract video info using the shared YoutubeDL instance."""
+    global _ydl  # pylint: disable=global-statement
+    if not _ydl_lock.acquire(timeout=_YDL_LOCK_TIMEOUT_SECS):  # pylint: disable=consider-using-with
+        # Don't queue up behind a slow lookup.
+        with YoutubeDL() as ydl:
+            return ydl.extract_info(url, download=False)
+    try:
+        if _ydl is None:
+            _ydl = YoutubeDL()
+        try:
+            return _ydl.extract_info(url, download=False)
+        except DownloadError as err:
+            if not _STALE_PLAYER_ERROR_PATTERN.search(str(err)):
+                raise
+    finally:
+        _ydl_lock.release()
+
+    # The cached player may be stale, retry once with a fresh instance outside the lock and
+    # share it if that works.
+    ydl = YoutubeDL()
+    try:
+        info = ydl.extract_info(url, download=False)
+    except BaseException:
+        ydl.close()
+        raise
+    with _ydl_lock:
+        ydl, _ydl = _ydl, ydl
+        if ydl is not None:
+            ydl.close()
+    return info
+
+
+# Video info by id, as (expiry time, info), in least recently used order. Entries expire well
+# before the stream urls in the info do.
+_VIDEO_INFO_CACHE_SIZE = 128
+_VIDEO_INFO_TTL_SECS = 3600
+_video_info_cache: 'collections.OrderedDict[str, Tuple[float, VideoInfo]]' = (
+    collections.OrderedDict())
+_video_info_cache_lock = threading.Lock()
+
+
+def get_video_info(vid: str) -> VideoInfo:
+    """Fetch the metadata for a youtube video id. Cached since songs are often requeued."""
+    now = time.monotonic()
+    with _video_info_cache_lock:
+        cached = _video_info_cache.get(vid)
+        if cached is not None and cached[0] > now:
+            _video_info_cache.move_to_end(vid)
+            return cached[1]
+    info = _extract_info(f'http://youtube.com/watch?v={vid}')
+    if info is None:
+        raise ValueError('Could not get video info!')
+    video_info = VideoInfo(
+        title=info['title'],
+        duration=info['duration'],
+        webpage_url=info['webpage_url'],
+        info=info)
+    with _video_info_cache_lock:
+        _video_info_cache[vid] = (now + _VIDEO_INFO_TTL_SECS, video_info)
+        _video_info_cache.move_to_end(vid)
+        while len(_video_info_cache) > _VIDEO_INFO_CACHE_SIZE:
+            _video_info_cache.popitem(last=False)
+    return video_info
+
+
+# Download locks by cache key with their number of users, so concurrent loads of the same video
+# download it once and the rest link the result from the cache.
+_download_locks: Dict[str, Tuple[threading.Lock, int]] = {}
+_download_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _download_lock(key: str, cancel: List[asyncio.Event]) -> Iterator[None]:
+    """Hold the download lock for a cache key. Stops waiting if any cancel event is set."""
+    with _download_locks_lock:
+        lock, users = _download_locks.get(key, (threading.Lock(), 0))
+        _download_locks[key] = (lock, users + 1)
+    try:
+        while not lock.acquire(timeout=0.5):
+            if any(event.is_set() for event in cancel):
+                raise asyncio.CancelledError()
+        try:
+            yield
+        finally:
+            lock.release()
+    finally:
+        with _download_locks_lock:
+            users = _download_locks[key][1] - 1
+            if users:
+                _download_locks[key] = (lock, users)
+            else:
+                del _download_locks[key]
 
 
 class YoutubeDownloader(common.Downloader):
@@ -27,28 +176,27 @@ class YoutubeDownloader(common.Downloader):
     async def load(
         self, interaction: discord.Interaction, url: str, *, video: bool, audio: bool,
     ) -> common.DownloadResult:
-        parts = re.split(YOUTUBE_PATTERN, url)
-        if len(parts) < 3:
-            raise ValueError('Unrecognized url!')
-        vid = re.split(r'[^0-9a-zA-Z_-]', parts[2])[0]
-        if len(vid) != 11:
+        vid = extract_video_id(url)
+        if vid is None:
             raise ValueError('Unrecognized url!')
 
         await utils.edit(interaction, content=f'Loading youtube id `{vid}`...')
         url = f'http://youtube.com/watch?v={vid}'
 
-        with YoutubeDL() as ydl:
-            info = ydl.extract_info(url, download=False)
-            if info is None:
-                raise ValueError('Could not get video info!')
-
-            if info['duration'] > common.VIDEO_LIMIT_MINS * 60:
-                raise ValueError(
-                    f'Please only queue videos shorter than {common.VIDEO_LIMIT_MINS} minutes.')
-            title = info['title']
-            await utils.edit(interaction, content=f'Loading youtube video `{title}`...')
+        info = await asyncio.to_thread(get_video_info, vid)
+        if info.duration > common.VIDEO_LIMIT_MINS * 60:
+            raise ValueError(
+                f'Please only queue videos shorter than {common.VIDEO_LIMIT_MINS} minutes.')
+        title = info.title
+        await utils.edit(interaction, content=f'Loading youtube video `{title}`...')
 
         def load_streams(entry: common.Entry, cancel: List[asyncio.Event]) -> common.LoadResult:
+            last_update = [0.0]
+            last_pct = [-1]
+            # The total size and its formatted string are resolved once per download instead of
+            # on every callback. Falls back to yt-dlp's running estimate until it is known.
+            total_size: List[Optional[int]] = [None]
+            total_size_str = ['']
 
             def progress_func(args):
                 for event in cancel:
@@ -56,42 +204,78 @@ class YoutubeDownloader(common.Downloader):
                         raise asyncio.CancelledError()
                 if args['status'] == 'error':
                     raise ValueError()
-                total_bytes = args.get('total_bytes', None)
-                if total_bytes is None and args.get('total_bytes_estimate', None) is not None:
-                    total_bytes = args['total_bytes_estimate']
+                if total_size[0] is None and args.get('total_bytes', None) is not None:
+                    total_size[0] = args['total_bytes']
+                    total_size_str[0] = f'{total_size[0] / 1024 / 1024:0.1f}Mb'
+                total_bytes = total_size[0]
+                if total_bytes is None:
+                    total_bytes = args.get('total_bytes_estimate', None)
                 downloaded = args.get('downloaded_bytes', 0)
+
+                # yt-dlp calls this for every downloaded block, so only update the message when the
+                # displayed percentage changed and at most every PROGRESS_INTERVAL_SECS.
+                now = time.monotonic()
+                pct = int(100 * downloaded / total_bytes) if total_bytes else downloaded
+                if args['status'] != 'finished' and (
+                        pct == last_pct[0] or now - last_update[0] < common.PROGRESS_INTERVAL_SECS):
+                    return
+                last_update[0] = now
+                last_pct[0] = pct
+
                 if total_bytes is None:
                     entry.load_msg = (
                         f'Loading youtube video `{title}`...\n'
                         f'Downloading... {downloaded} bytes downloaded')
                 else:
-                    progress = StringProgressBar.progressBar.filledBar(
-                        total_bytes, downloaded)  # type: ignore
-                    total_bytes_mb = max(downloaded, total_bytes) / 1024 / 1024
+                    progress = utils.progress_bar(total_bytes, downloaded)
+                    size_str = total_size_str[0]
+                    if not size_str:
+                        size_str = f'{max(downloaded, total_bytes) / 1024 / 1024:0.1f}Mb'
                     entry.load_msg = (
                         f'Loading youtube video `{title}`...\n'
-                        f'Downloading: {progress[0]} {progress[1]:0.0f}% of {total_bytes_mb:0.1f}Mb')
-
-            ydl_opts: dict[str, Any] = {
-                'format': 'best[ext=mp4]',
-                'paths': {'home': entry.path},
-                'outtmpl': {'default': 'download.%(ext)s'},
-                'progress_hooks': [progress_func],
-            }
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            video_path = 'download.mp4'
+                        f'Downloading: {progress[0]} {progress[1]:0.0f}% of {size_str}')
+
+            # Only download the streams that are needed, picked by yt-dlp in a single pass over
+            # the available formats.
+            if video and audio:
+                download_format = 'best[ext=mp4]'
+                download_path = 'download.mp4'
+            elif video:
+                download_format = 'bestvideo[ext=mp4][height<=720]/best[ext=mp4]'
+                download_path = 'video.mp4'
+            else:
+                download_format = 'bestaudio[ext=m4a]/best[ext=mp4]'
+                download_path = 'audio.m4a'
+            cache_key = f'youtube-{vid}-{download_path}'
+            with _download_lock(cache_key, cancel):
+                if not common.cache_get(cache_key, os.path.join(entry.path, download_path)):
+                    ydl_opts: dict[str, Any] = {
+                        'format': download_format,
+                        'paths': {'home': entry.path},
+                        'outtmpl': {'default': download_path},
+                        'progress_hooks': [progress_func],
+                        'http_chunk_size': _HTTP_CHUNK_SIZE,
+                        'concurrent_fragment_downloads': _CONCURRENT_FRAGMENTS,
+                        'buffersize': common.DOWNLOAD_BUFFER_SIZE,
+                    }
+                    with YoutubeDL(ydl_opts) as ydl:
+                        # Pick the format from the info we already extracted instead of fetching
+                        # and parsing all the formats again. The stream urls expire after a few
+                        # hours, so fall back to a fresh extraction if the cached info is too old.
+                        try:
+                            ydl.process_ie_result(copy.deepcopy(info.info), download=True)
+                        except DownloadError:
+                            ydl.download([url])
+                    common.cache_put(cache_key, os.path.join(entry.path, download_path))
 
             result = common.LoadResult()
             if video:
-                result.video_path = video_path
+                result.video_path = download_path
             if audio:
-                result.audio_path = 'audio.mp3'
-                utils.call('ffmpeg', f'-i "{os.path.join(entry.path, video_path)}" '
-                           f'-ac 2 -f mp3 "{os.path.join(entry.path, result.audio_path)}"')
+                result.audio_path = download_path
             return result
 
         return common.DownloadResult(
             title=title,
-            original_url=info['webpage_url'],
+            original_url=info.webpage_url,
             load_fn=functools.partial(asyncio.to_thread, load_streams))
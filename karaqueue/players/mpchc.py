@@ -12,12 +12,15 @@ _WEBPORT = 'webport'
 WEBPORT = common.CONFIG.get(_SECTION, _WEBPORT, fallback=None)
 STATS_PAGE = f'http://localhost:{WEBPORT}/variables.html'
 
+# The stats page is polled repeatedly, so keep the connection alive between polls.
+_session = requests.Session()
+
 
 class MpcHcPlayer(common.Player):
     """MPC-HC Player."""
     async def get_status(self) -> Optional[common.PlayerStatus]:
         try:
-            page = await asyncio.to_thread(requests.get, STATS_PAGE, timeout=1)
+            page = await asyncio.to_thread(_session.get, STATS_PAGE, timeout=1)
         except (requests.exceptions.ConnectTimeout, TimeoutError):
             return None
         soup = BeautifulSoup(page.text, 'html.parser')
@@ -1,36 +1,67 @@
 """Utils."""
+import asyncio
 import logging
 import platform
 import subprocess
-from typing import Union
+from typing import List, Optional, Tuple, Union
 import discord
 
 
-def call(binary: str, cmd: str, return_stdout: bool = False, background: bool = False) -> str:
-    """Call a local binary with a command."""
+# Keep ffmpeg from reading stdin or logging anything but errors.
+FFMPEG_FLAGS = ['-nostdin', '-nostats', '-loglevel', 'error']
+
+
+def call(
+    binary: str, args: List[str], return_stdout: bool = False, background: bool = False,
+    cancel: Optional[List[asyncio.Event]] = None,
+) -> str:
+    """Call a local binary with a list of arguments.
+
+    If cancel is given, the process is terminated as soon as any of the events is set.
+    """
     if platform.system() == 'Windows' and not binary.endswith('.exe'):
         binary = f'{binary}.exe'
+    cmd = [binary, *args]
     if return_stdout:
         try:
-            result = subprocess.run(
-                f'"{binary}" {cmd}', shell=True, check=True, capture_output=True)
+            result = subprocess.run(cmd, check=True, capture_output=True)
             return result.stdout.decode('utf-8')
         except subprocess.CalledProcessError as err:
-            logging.error(err.stdout.decode('utf-8'))
-            logging.error(err.stderr.decode('utf-8'))
+            logging.error(err.stdout.decode('utf-8', 'replace'))
+            logging.error(err.stderr.decode('utf-8', 'replace'))
             raise
     if background:
-        subprocess.Popen(f'"{binary}" {cmd}', shell=True)  # pylint: disable=consider-using-with
+        subprocess.Popen(cmd)  # pylint: disable=consider-using-with
+        return ''
+    if cancel:
+        with subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as proc:
+            while True:
+                try:
+                    _, stderr = proc.communicate(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    if any(event.is_set() for event in cancel):
+                        proc.terminate()
+                        raise asyncio.CancelledError()  # pylint: disable=raise-missing-from
+        if proc.returncode:
+            logging.error(stderr.decode('utf-8', 'replace'))
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
         return ''
     try:
-        subprocess.run(f'"{binary}" {cmd}', shell=True, check=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         return ''
     except subprocess.CalledProcessError as err:
-        logging.error(err.stdout.decode('utf-8'))
+        logging.error(err.stderr.decode('utf-8', 'replace'))
         raise
 
 
+def progress_bar(total: float, current: float, size: int = 40) -> Tuple[str, float]:
+    """Render a text progress bar. Returns the bar and the percentage done."""
+    fraction = min(current / total, 1.0) if total else 0.0
+    filled = round(size * fraction)
+    return '\u25a0' * filled + '\u25a1' * (size - filled), 100 * fraction
+
+
 DiscordContext = Union[discord.ApplicationContext, discord.Interaction]
 DiscordMessage = Union[discord.Interaction,
                        discord.InteractionMessage,
@@ -39,7 +70,11 @@ DiscordMessage = Union[discord.Interaction,
 
 
 async def respond(ctx: DiscordContext, *args, **kwargs) -> DiscordMessage:
-    """Post a response to a discord interaction."""
+    """Post a response to a discord interaction.
+
+    Returns the posted message. Ephemeral initial responses return the interaction instead, since
+    nothing reads them back and resolving the message would cost an extra request.
+    """
     interaction: discord.Interaction
     if isinstance(ctx, discord.ApplicationContext):
         interaction = ctx.interaction
@@ -48,13 +83,16 @@ async def respond(ctx: DiscordContext, *args, **kwargs) -> DiscordMessage:
 
     async def send_followup():
         try:
-            return await interaction.followup.send(*args, **kwargs)
+            return await interaction.followup.send(*args, wait=True, **kwargs)
         except discord.errors.HTTPException:
             return await interaction.channel.send(*args, **kwargs)
 
     try:
         if not interaction.response.is_done():
-            return await interaction.response.send_message(*args, **kwargs)
+            await interaction.response.send_message(*args, **kwargs)
+            if kwargs.get('ephemeral'):
+                return interaction
+            return await interaction.original_response()
         return await send_followup()
     except discord.errors.InteractionResponded:
         return await send_followup()
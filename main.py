@@ -1,15 +1,18 @@
 """Karaqueue discord bot."""
 import asyncio
+import contextlib
 import datetime
 import itertools
 import logging
 import math
 import os
 import pathlib
+import platform
+import shlex
+import shutil
 import signal
 import tempfile
-import typing
-from typing import Optional
+from typing import Optional, Tuple
 from absl import app
 from absl import flags
 import discord
@@ -57,9 +60,38 @@ LAUNCH_OPTS = common.CONFIG[_DEFAULT].get('launch_opts')
 os.makedirs(common.SERVING_DIR, exist_ok=True)
 
 
-# A new video is queued for offline processing.
 global_cancel = asyncio.Event()
-new_process_task = asyncio.Condition()
+# Entries waiting to be processed, as (priority, seq, entry). The currently playing entry goes
+# first, then entries in the order they will be played.
+process_queue: 'asyncio.PriorityQueue[Tuple[int, int, common.Entry]]' = asyncio.PriorityQueue()
+_process_seq = itertools.count()
+
+
+def _push_process(q: common.Queue, entry: common.Entry):
+    """Add an entry to the processing queue."""
+    entry.process_schedule_handle = None
+    if entry is q.current:
+        priority = 0
+    else:
+        priority = 1 + next((i for i, e in enumerate(q) if e is entry), len(q))
+    process_queue.put_nowait((priority, entry.process_seq, entry))
+
+
+def _schedule_process_locked(q: common.Queue, entry: common.Entry, debounce: bool = False):
+    """Schedule an entry for processing.
+
+    With debounce, processing only starts once the entry has not been changed for
+    REPROCESS_DEBOUNCE_SECS, so rapid edits don't each start a run that gets cancelled.
+    """
+    # Items already in process_queue for this entry are skipped once the seq changes.
+    entry.process_seq = next(_process_seq)
+    if not debounce:
+        _push_process(q, entry)
+        return
+    if entry.process_schedule_handle is not None:
+        entry.process_schedule_handle.cancel()
+    entry.process_schedule_handle = bot.loop.call_later(
+        common.REPROCESS_DEBOUNCE_SECS, _push_process, q, entry)
 
 
 class AddSongModal(discord.ui.Modal):
@@ -99,6 +131,16 @@ class EmptyQueueView(discord.ui.View):
         await interaction.response.send_modal(AddSongModal(title='Add Song'))
 
 
+class QueueView(EmptyQueueView):
+    """Discord view for when queue is not empty. Has a Next Song button."""
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.primary, custom_id='next_song')
+    async def next_callback(self, _, interaction):
+        """Play the next song."""
+        logging.info('Next called from button click.')
+        await _next(interaction, is_user_action=True)
+
+
 bot = commands.Bot()
 
 
@@ -106,6 +148,7 @@ bot = commands.Bot()
 async def on_ready():
     """Register persistent views."""
     bot.add_view(EmptyQueueView())
+    bot.add_view(QueueView())
 
 
 def _is_dev_id(author_id) -> bool:
@@ -178,16 +221,10 @@ async def _load(
     video_url = video_url.strip()
     audio_url = audio_url.strip()
     q = await common.get_queue(interaction)
-    if len(q) >= common.MAX_QUEUED:
-        await utils.respond(
-            interaction, 'Queue is full! Delete some items with `/delete`', ephemeral=True)
-        return
-    if (not _is_dev_id(user.id) and
-            sum(entry.user_id == user.id for entry in q) >= q.per_user_limit):
-        await utils.respond(
-            interaction,
-            f'Each user may only have {q.per_user_limit} songs in the queue!',
-            ephemeral=True)
+    # Reject early without the lock; the check is repeated under the lock before appending.
+    error = _check_queue_limits(q, user.id)
+    if error:
+        await utils.respond(interaction, error, ephemeral=True)
         return
 
     await utils.respond(interaction, f'Loading `{video_url}`...', ephemeral=True)
@@ -200,21 +237,21 @@ async def _load(
                 return await downloader.load(interaction, url, video=video, audio=audio)
         raise ValueError(f'Unrecognized url `{url}`')
 
+    # Look up the video and audio urls concurrently.
+    downloads = [asyncio.create_task(download(video_url, video=True, audio=not audio_url))]
+    if audio_url != "":
+        downloads.append(asyncio.create_task(download(audio_url, video=False, audio=True)))
     try:
-        video_result = await download(video_url, video=True, audio=not audio_url)
+        results = await asyncio.gather(*downloads)
     except Exception as err:  # pylint: disable=broad-except
+        # Don't let the other lookup keep editing the response after the error is reported.
+        for task in downloads:
+            task.cancel()
         logging.exception(err)
         await utils.respond(interaction, f'Error: {err}', ephemeral=True)
         return
-    load_fns = [video_result.load_fn]
-    if audio_url != "":
-        try:
-            audio_result = await download(audio_url, video=False, audio=True)
-        except Exception as err:  # pylint: disable=broad-except
-            logging.exception(err)
-            await utils.respond(interaction, f'Error: {err}', ephemeral=True)
-            return
-        load_fns.append(audio_result.load_fn)
+    video_result = results[0]
+    load_fns = [result.load_fn for result in results]
     entry = common.Entry(
         path=path,
         title=video_result.title,
@@ -226,47 +263,66 @@ async def _load(
         offset_ms=offset_ms)
     # Delete the loading message.
     await interaction.delete_original_response()
+    queue_updated = False
     async with q.lock:
-        q.append(entry)
-        if q.current is not None:
-            await print_queue_locked(interaction, q)
-            entry.onchange_locked()
-            async with new_process_task:
-                new_process_task.notify()
-        else:
-            logging.info('Next called from load because nothing is playing.')
-            await _next_locked(interaction, q, is_user_action=False)
+        error = _check_queue_limits(q, user.id)
+        if not error:
+            q.append(entry)
+            queue_updated = q.current is not None
+            if queue_updated:
+                entry.onchange_locked()
+                _schedule_process_locked(q, entry)
+            else:
+                logging.info('Next called from load because nothing is playing.')
+                await _next_locked(interaction, q, is_user_action=False)
+    if error:
+        await utils.respond(interaction, error, ephemeral=True)
+        await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+    elif queue_updated:
+        await print_queue(interaction, q)
+
+
+def _check_queue_limits(q: common.Queue, user_id: int) -> str:
+    """Returns an error message if the user may not add another song to the queue."""
+    if len(q) >= common.MAX_QUEUED:
+        return 'Queue is full! Delete some items with `/delete`'
+    if not _is_dev_id(user_id) and q.user_counts[user_id] >= q.per_user_limit:
+        return f'Each user may only have {q.per_user_limit} songs in the queue!'
+    return ''
 
 
 @bot.slash_command(name='pitch')
 async def command_pitch(ctx: discord.ApplicationContext, pitch: int, index: int = 0):
     """Change the pitch of a song."""
     q = await common.get_queue(ctx)
+    error = ''
     current_updated = False
+    queue_updated = False
     async with q.lock:
         if index < 0 or index > len(q):
-            await utils.respond(ctx, 'Invalid index!', ephemeral=True)
-            return
-        if index == 0:
+            error = 'Invalid index!'
+        elif index == 0:
             if q.current is None:
-                await utils.respond(ctx, 'No song currently playing!', ephemeral=True)
-                return
-            if q.current.pitch_shift != pitch:
+                error = 'No song currently playing!'
+            elif q.current.pitch_shift != pitch:
                 q.current.pitch_shift = pitch
                 q.current.onchange_locked()
-                async with new_process_task:
-                    new_process_task.notify()
+                _schedule_process_locked(q, q.current, debounce=True)
                 current_updated = True
-        elif index <= len(q):
+        else:
             entry = q[index-1]
             if entry.pitch_shift != pitch:
                 entry.pitch_shift = pitch
-                await print_queue_locked(ctx, q)
                 entry.onchange_locked()
-                async with new_process_task:
-                    new_process_task.notify()
+                _schedule_process_locked(q, entry, debounce=True)
+                queue_updated = True
+    if error:
+        await utils.respond(ctx, error, ephemeral=True)
+        return
+    if queue_updated:
+        await print_queue(ctx, q)
     if current_updated:
-        await _update_with_current(ctx)
+        await _update_with_current(ctx, q)
 
 
 @bot.slash_command(name='offset')
@@ -275,6 +331,7 @@ async def command_offset(
 ):
     """Change the offset of a song."""
     q = await common.get_queue(ctx)
+    response = ''
     current_updated = False
     async with q.lock:
         if index is None:
@@ -282,45 +339,40 @@ async def command_offset(
                 q.global_offset_ms = offset_ms
                 if q.current is not None:
                     q.current.onchange_locked()
+                    _schedule_process_locked(q, q.current, debounce=True)
                     current_updated = True
                 for entry in q:
                     entry.onchange_locked()
-                async with new_process_task:
-                    new_process_task.notify()
-            await utils.respond(ctx, f'Updated global offset to {offset_ms}', ephemeral=True)
+                    _schedule_process_locked(q, entry, debounce=True)
+            response = f'Updated global offset to {offset_ms}'
+        elif index < 0 or index > len(q):
+            response = 'Invalid index!'
+        elif index == 0:
+            if q.current is None:
+                response = 'No song currently playing!'
+            elif q.current.offset_ms != offset_ms:
+                q.current.offset_ms = offset_ms
+                q.current.onchange_locked()
+                _schedule_process_locked(q, q.current, debounce=True)
+                current_updated = True
         else:
-            if index < 0 or index > len(q):
-                await utils.respond(ctx, 'Invalid index!', ephemeral=True)
-                return
-            if index == 0:
-                if q.current is None:
-                    await utils.respond(ctx, 'No song currently playing!', ephemeral=True)
-                    return
-                if q.current.offset_ms != offset_ms:
-                    q.current.offset_ms = offset_ms
-                    q.current.onchange_locked()
-                    async with new_process_task:
-                        new_process_task.notify()
-                    current_updated = True
-            elif index <= len(q):
-                entry = q[index-1]
-                if entry.offset_ms != offset_ms:
-                    entry.offset_ms = offset_ms
-                    entry.onchange_locked()
-                    async with new_process_task:
-                        new_process_task.notify()
-                await utils.respond(
-                    ctx, f'Updated offset for {entry.title} to {offset_ms}', ephemeral=True)
+            entry = q[index-1]
+            if entry.offset_ms != offset_ms:
+                entry.offset_ms = offset_ms
+                entry.onchange_locked()
+                _schedule_process_locked(q, entry, debounce=True)
+            response = f'Updated offset for {entry.title} to {offset_ms}'
+    if response:
+        await utils.respond(ctx, response, ephemeral=True)
     if current_updated:
-        await _update_with_current(ctx)
+        await _update_with_current(ctx, q)
 
 
 @bot.slash_command(name='list')
 async def command_list(ctx: discord.ApplicationContext):
     """Show the queue."""
     q = await common.get_queue(ctx)
-    async with q.lock:
-        await print_queue_locked(ctx, q)
+    await print_queue(ctx, q)
 
 
 @bot.slash_command(name='next')
@@ -355,46 +407,55 @@ async def _next_locked(ctx: utils.DiscordContext, q: common.Queue, is_user_actio
     if len(q) == 0:
         await utils.respond(ctx, content='No songs in queue!')
         return
-    q.current = q.pop(0)
-    async with new_process_task:
-        new_process_task.notify()
-    bot.loop.create_task(_update_with_current(ctx, delete_old_queue_msg=False))
+    q.current = q.popleft()
+    _schedule_process_locked(q, q.current)
+    bot.loop.create_task(_update_with_current(ctx, q, delete_old_queue_msg=False))
 
 
-async def _update_with_current(ctx: utils.DiscordContext, delete_old_queue_msg: bool = True):
+async def _update_with_current(
+    ctx: utils.DiscordContext, q: common.Queue, delete_old_queue_msg: bool = True,
+):
     """Update the currently playing song in the queue."""
-    q = await common.get_queue(ctx)
     if q.local and not LAUNCH_BINARY:
         await utils.respond(
             ctx, content='launch_binary must be configured for local mode.', ephemeral=True)
         return
-    async with q.lock:
-        entry = q.current
-        if entry is None:
-            return
-        await print_queue_locked(ctx, q, delete_old_queue_msg)
+    entry = q.current
+    if entry is None:
+        return
+    await print_queue(ctx, q, delete_old_queue_msg)
     resp = await utils.respond(ctx, content=f'Loading `{entry.name}`...')
-    if isinstance(resp, discord.Interaction):
-        resp = await resp.original_response()
-    spinner = itertools.cycle(['|', '/', '-', '\\'])
-    cur_msg = ''
-    while not entry.processed:
+    spinner = itertools.cycle(
+        [f'Loading `{entry.name}`...\n`{frame * 4}`' for frame in ('|', '/', '-', '\\')])
+    last_sent = f'Loading `{entry.name}`...'
+    while True:
+        # Failed entries are marked processed as well, so check for errors first.
         if entry.error_msg:
             await resp.edit(content=f'Loading `{entry.name}`...\n{entry.error_msg}')
             return
-        if entry.load_msg:
-            if entry.load_msg != cur_msg:
-                await resp.edit(content=entry.load_msg)
-            await asyncio.sleep(0.1)
-        else:
-            await resp.edit(content=f'Loading `{entry.name}`...\n`' + next(spinner)*4 + '`')
-            await asyncio.sleep(0.1)
+        if entry.processed:
+            break
+        # load_msg only holds the latest progress message, so intermediate updates written by
+        # the loaders while we wait here are coalesced into a single edit.
+        load_msg = entry.load_msg
+        content = load_msg or next(spinner)
+        if content != last_sent:
+            last_sent = content
+            await resp.edit(content=content)
+            await asyncio.sleep(common.PROGRESS_INTERVAL_SECS)
+
+        # Without a progress message, tick the spinner slowly but still pick up a new message as
+        # soon as it arrives.
+        timeout = None if load_msg else common.SPINNER_INTERVAL_SECS
+        with contextlib.suppress(asyncio.TimeoutError):
+            while not (entry.processed or entry.error_msg or entry.load_msg != load_msg):
+                await asyncio.wait_for(entry.changed.wait(), timeout)
     logging.info(f'Now playing {entry.name} {entry.url()}')
     if q.local:
         await resp.edit(content=f'**Now playing**\n[`{entry.name}`](<{entry.original_url}>)')
-        args = f'"{entry.video_path()}"'
+        args = [entry.video_path()]
         if LAUNCH_OPTS:
-            args += f' {LAUNCH_OPTS}'
+            args += shlex.split(LAUNCH_OPTS, posix=platform.system() != 'Windows')
         utils.call(LAUNCH_BINARY, args, background=True)
 
         if PLAYER:
@@ -445,40 +506,50 @@ async def command_remove(ctx: discord.ApplicationContext, index: int):
     await _delete(ctx, index)
 
 
-async def _delete(ctx: discord.ApplicationContext, index: int):
-    """Delete a song from the queue."""
-    q = await common.get_queue(ctx)
-    async with q.lock:
-        if index < 1 or index > len(q):
-            await utils.respond(ctx, 'Invalid index!', ephemeral=True)
-            return
-        entry = q[index-1]
+class DeleteConfirmView(discord.ui.View):
+    """Confirmation dialog for deleting a song."""
 
-    class DeleteConfirmView(discord.ui.View):
-        """Confirmation dialog for deleting a song."""
-
-        def __init__(self):
-            super().__init__(timeout=None)
-
-        @discord.ui.button(label='Delete', style=discord.ButtonStyle.red)
-        async def delete_callback(self, _, __):
-            """Delete a song from the queue."""
-            async with q.lock:
-                for i, _ in enumerate(q):
-                    if q[i] == entry:
-                        q[i].delete()
-                        del q[i]
-                        break
-                await utils.respond(ctx, f'Successfully deleted `{entry.title}` from the queue.')
-                await print_queue_locked(ctx, q, delete_old_queue_msg=False)
-            await utils.delete(ctx)
+    def __init__(
+        self, ctx: discord.ApplicationContext, q: common.Queue, index: int, entry: common.Entry,
+    ):
+        super().__init__(timeout=None)
+        self._ctx = ctx
+        self._q = q
+        self._index = index
+        self._entry = entry
+
+    @discord.ui.button(label='Delete', style=discord.ButtonStyle.red)
+    async def delete_callback(self, _, __):
+        """Delete a song from the queue."""
+        ctx, q, entry = self._ctx, self._q, self._entry
+        async with q.lock:
+            i = self._index
+            if not (i < len(q) and q[i] is entry):
+                # The queue changed before the deletion was confirmed.
+                i = next((j for j, e in enumerate(q) if e is entry), -1)
+            if i >= 0:
+                entry.delete()
+                del q[i]
+        await utils.respond(ctx, f'Successfully deleted `{entry.title}` from the queue.')
+        await print_queue(ctx, q, delete_old_queue_msg=False)
+        await utils.delete(ctx)
+
+    @discord.ui.button(label='Cancel', style=discord.ButtonStyle.gray)
+    async def cancel_callback(self, _, __):
+        """Cancel deleting song."""
+        await utils.delete(self._ctx)
 
-        @discord.ui.button(label='Cancel', style=discord.ButtonStyle.gray)
-        async def cancel_callback(self, _, __):
-            """Cancel deleting song."""
-            await utils.delete(ctx)
 
-    await utils.respond(ctx, f'Deleting `{entry.title}`, are you sure?', view=DeleteConfirmView())
+async def _delete(ctx: discord.ApplicationContext, index: int):
+    """Delete a song from the queue."""
+    q = await common.get_queue(ctx)
+    if index < 1 or index > len(q):
+        await utils.respond(ctx, 'Invalid index!', ephemeral=True)
+        return
+    entry = q[index-1]
+    await utils.respond(
+        ctx, f'Deleting `{entry.title}`, are you sure?',
+        view=DeleteConfirmView(ctx, q, index-1, entry))
 
 
 @bot.slash_command(name='move')
@@ -486,14 +557,15 @@ async def command_move(ctx: discord.ApplicationContext, index_from: int, index_t
     """Change the position of a song in the queue."""
     q = await common.get_queue(ctx)
     async with q.lock:
-        if (index_from < 1 or index_from > len(q)
-                or index_to < 1 or index_to > len(q)):
-            await utils.respond(ctx, 'Invalid index!', ephemeral=True)
-            return
-        entry = q[index_from-1]
-        del q[index_from-1]
-        q.insert(index_to-1, entry)
-        await print_queue_locked(ctx, q)
+        valid = 1 <= index_from <= len(q) and 1 <= index_to <= len(q)
+        if valid:
+            entry = q[index_from-1]
+            del q[index_from-1]
+            q.insert(index_to-1, entry)
+    if not valid:
+        await utils.respond(ctx, 'Invalid index!', ephemeral=True)
+        return
+    await print_queue(ctx, q)
 
 
 @bot.slash_command(name='reload')
@@ -501,14 +573,15 @@ async def command_reload(ctx: discord.ApplicationContext):
     """Reload the current song."""
     q= await common.get_queue(ctx)
     async with q.lock:
-        if not q.current:
-            await utils.respond(ctx, 'No current song to reload!', ephemeral=True)
-            return
-        q.current.onchange_locked()
-        async with new_process_task:
-            new_process_task.notify()
+        current = q.current
+        if current is not None:
+            current.onchange_locked()
+            _schedule_process_locked(q, current)
+    if current is None:
+        await utils.respond(ctx, 'No current song to reload!', ephemeral=True)
+        return
     await utils.respond(ctx, content='Success', ephemeral=True)
-    await _update_with_current(ctx)
+    await _update_with_current(ctx, q)
 
 
 async def is_dev(ctx: commands.Context) -> bool:
@@ -556,44 +629,98 @@ async def command_dev(ctx: discord.ApplicationContext, command: str):
         await utils.respond(ctx, content=f'Unrecognized command {command}', ephemeral=True)
 
 
-async def print_queue_locked(
+async def _ack_queue_updated(ctx: utils.DiscordContext):
+    """Respond to the interaction if it hasn't been responded to yet."""
+    interaction = ctx.interaction if isinstance(ctx, discord.ApplicationContext) else ctx
+    if not interaction.response.is_done():
+        await utils.respond(ctx, content='Queue updated.', ephemeral=True)
+
+
+async def print_queue(
     ctx: utils.DiscordContext, q: common.Queue, delete_old_queue_msg: bool = True,
 ):
-    """Print the current queue."""
-    if delete_old_queue_msg and q.msg_id is not None:
-        try:
-            channel = typing.cast(discord.TextChannel,
-                                  bot.get_channel(q.channel_id))
-            message = await channel.fetch_message(q.msg_id)
-            await message.delete()
-        except Exception:  # pylint: disable=broad-exception-caught
-            # Message already deleted, etc.
-            pass
-    q.msg_id = None
+    """Print the current queue.
+
+    Doesn't need the queue lock, so commands aren't blocked on the Discord requests. msg_lock
+    keeps concurrent prints from each posting their own queue message.
+
+    Prints requested within PRINT_QUEUE_DEBOUNCE_SECS of each other are coalesced, so a burst
+    of changes only reposts the queue message once.
+    """
+    q.print_seq += 1
+    seq = q.print_seq
+    await asyncio.sleep(common.PRINT_QUEUE_DEBOUNCE_SECS)
+    if seq != q.print_seq:
+        # A newer print will show this change as well, just acknowledge the interaction.
+        await _ack_queue_updated(ctx)
+        return
+    async with q.msg_lock:
+        await _print_queue_msg_locked(ctx, q, delete_old_queue_msg)
+
+
+def _queue_message(q: common.Queue, msg_id: int) -> discord.PartialMessage:
+    """Get the queue message by id.
 
+    Edited and deleted with the bot token, since the token of the interaction that posted it
+    expires after 15 minutes.
+    """
+    return bot.get_partial_messageable(q.channel_id).get_partial_message(msg_id)
+
+
+def _is_latest_message(q: common.Queue, msg_id: int) -> bool:
+    """Whether msg_id is still the last message in the queue's channel."""
+    channel = bot.get_channel(q.channel_id)
+    return getattr(channel, 'last_message_id', None) == msg_id
+
+
+async def _print_queue_msg_locked(
+    ctx: utils.DiscordContext, q: common.Queue, delete_old_queue_msg: bool,
+):
+    """Print the current queue while holding msg_lock."""
     msg = ''
     if q.current:
         msg = f'**Now playing**\n`{q.current.name}`'
+    view: discord.ui.View
     if len(q) == 0:
         msg = f'{msg}\nNo songs in queue!'.strip()
-        msg = await utils.respond(ctx, content=msg, view=EmptyQueueView())
+        view = EmptyQueueView()
     else:
         msg = f'{msg}\n**Up Next**\n{q.format()}'.strip()
+        view = QueueView()
 
-        class QueueView(EmptyQueueView):
-            """Discord view for when queue is not empty. Has a Next Song button."""
-
-            @discord.ui.button(label='Next', style=discord.ButtonStyle.primary)
-            async def next_callback(self, _, __):
-                """Play the next song."""
-                logging.info('Next called from button click.')
-                await _next(ctx, is_user_action=True)
+    delete_task: Optional[asyncio.Task] = None
+    if delete_old_queue_msg and q.msg_id is not None:
+        old_msg = _queue_message(q, q.msg_id)
+        # If the queue message is still the latest message in the channel, update it in place
+        # instead of deleting and reposting it.
+        edited = False
+        try:
+            if _is_latest_message(q, q.msg_id):
+                await old_msg.edit(content=msg, view=view)
+                edited = True
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Message already deleted, etc. Fall back to deleting and reposting it.
+            pass
+        if edited:
+            await _ack_queue_updated(ctx)
+            return
 
-        msg = await utils.respond(ctx, msg, view=QueueView())
+        async def delete_old_msg():
+            try:
+                await old_msg.delete()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Message already deleted, etc.
+                pass
+        # Deleting the old message and posting the new one are independent requests.
+        delete_task = asyncio.create_task(delete_old_msg())
+    q.msg_id = None
 
-    if isinstance(msg, discord.Interaction):
-        msg = await msg.original_response()
-    q.msg_id = msg.id
+    try:
+        resp = await utils.respond(ctx, content=msg, view=view)
+        q.msg_id = resp.id
+    finally:
+        if delete_task is not None:
+            await delete_task
 
 
 def main(_):
@@ -606,27 +733,36 @@ def main(_):
 
     async def background_process():
         while True:
-            entry_to_process = None
-            async with new_process_task:
-                # Find next entry to process.
-                for q in common.queues.values():
-                    if q.current is not None and not q.current.processed:
-                        entry_to_process = q.current
-                    else:
-                        for entry in q:
-                            if not entry.processed:
-                                entry_to_process = entry
-                                break
-                    if entry_to_process is not None:
-                        break
-                if entry_to_process is None:
-                    await new_process_task.wait()
-                    continue
+            _, seq, entry_to_process = await process_queue.get()
+            # Skip stale queue items for entries that were rescheduled since, are already done,
+            # are being processed by another worker, or are no longer queued.
+            q = entry_to_process.queue
+            if (seq != entry_to_process.process_seq or
+                    entry_to_process.processed or entry_to_process.processing or
+                    (entry_to_process is not q.current and
+                     all(entry is not entry_to_process for entry in q))):
+                continue
             try:
                 await entry_to_process.create_process_task(bot.loop, global_cancel)
             except asyncio.CancelledError:
                 pass
-    bot.loop.create_task(background_process())
+            except Exception as err:  # pylint: disable=broad-except
+                # Keep the worker alive for the next entries.
+                logging.exception(err)
+    # The heavy lifting happens in ffmpeg subprocesses, so a few workers can process entries on
+    # separate cores at the same time.
+    for _ in range(common.PROCESS_WORKERS):
+        bot.loop.create_task(background_process())
+
+    # Entry directories left behind by a previous run. Listed now so entries created after
+    # startup are never removed, but deleted in the background so login isn't delayed.
+    with os.scandir(common.SERVING_DIR) as it:
+        stale_paths = [item.path for item in it if item.is_dir() and item.name.startswith('tmp')]
+
+    async def remove_stale_paths():
+        for path in stale_paths:
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+    bot.loop.create_task(remove_stale_paths())
     bot.run(BOT_TOKEN)
 
 